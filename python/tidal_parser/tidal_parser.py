@@ -20,11 +20,64 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import io
+import mmap
+import os
 import struct
+import tempfile
 
 import numpy as np
 
+try:
+    import numba
+    from numba import prange
+except ImportError:  # numba is optional, data records are then scanned in pure Python
+    numba = None
+    prange = range
+
+
+_DATA_HEADER_SIZE = 1 + 4  # data marker and stream ID
+
+
+def _scan_data_records(buf, off, stop, marker, stream_index, record_sizes, offsets, stream_indices):
+    """Scans consecutive data records starting at buf[off], returning the end offset and record count
+
+    Stores the timestamp offset and stream index of each record in offsets and
+    stream_indices, and stops at the first record starting at or after stop, at
+    any other marker, at a stream ID whose entry in stream_index is missing or
+    -1, at a truncated record, or when the outputs are full.
+    """
+    size = buf.shape[0]
+    count = 0
+    while count < offsets.shape[0] and off < stop and off + _DATA_HEADER_SIZE <= size and buf[off] == marker:
+        stream_id = buf[off + 1:off + _DATA_HEADER_SIZE].view(np.uint32)[0]
+        if stream_id >= stream_index.shape[0] or stream_index[stream_id] < 0:
+            break
+
+        index = stream_index[stream_id]
+        end = off + _DATA_HEADER_SIZE + record_sizes[index]
+        if end > size:
+            break
+
+        offsets[count] = off + _DATA_HEADER_SIZE
+        stream_indices[count] = index
+        count += 1
+        off = end
+
+    return off, count
+
+
+def _gather_records(buf, offsets, items):
+    """Copies the items starting at each of the given offsets of buf into the rows of items"""
+    size = items.shape[1]
+    for i in prange(offsets.shape[0]):
+        off = offsets[i]
+        items[i, :] = buf[off:off + size]
+
+
+if numba is not None:
+    _scan_data_records = numba.njit(cache=True)(_scan_data_records)
+    _gather_records = numba.njit(cache=True, parallel=True)(_gather_records)
+
 
 class ParserError(Exception):
     """Base class for parser module exceptions"""
@@ -40,19 +93,34 @@ class Parser:
     # miscellaneous constants
     EOF = b''
     NULL_TERMINATOR = b'\x00'
+    READ_BUFFER_SIZE = 1 << 24  # bytes per read for files that cannot be mapped
 
     # binary format specification
     MARKER_METADATA = b'\xA5'
     MARKER_LABELS = b'\x66'
     MARKER_DATA = b'\xDB'
 
+    # markers as the ints yielded by indexing the mapped file
+    _MARKER_METADATA = MARKER_METADATA[0]
+    _MARKER_LABELS = MARKER_LABELS[0]
+    _MARKER_DATA = MARKER_DATA[0]
+
     TIMESTAMP_DTYPE = np.dtype('uint64')
 
+    # limits for scanning and copying data records
+    SCAN_MAX_STREAM_ID = 0xFFFF  # records of streams with larger IDs or indices are scanned in Python
+    SCAN_CHUNK_RECORDS = 1 << 16  # number of records scanned per call
+    GATHER_BLOCK_RECORDS = 1 << 16  # number of records copied per block without numba
+
     TYPE_STREAM_ID = 'I'  # uint32 (format specifier struct package)
-    TYPE_DATA_CLASS = 'B'  # uint8 (format specifier for struct package)
-    TYPE_SCALAR_TYPE = 'B'  # uint8 (format specifier for struct package)
+    TYPE_DATA_CLASS = 'B'  # uint8 (describes the format only, read as a single byte)
+    TYPE_SCALAR_TYPE = 'B'  # uint8 (describes the format only, read as a single byte)
     TYPE_DATA_SIZE = 'I'  # uint32 (format specifier for struct package)
 
+    # binary format decoders
+    _STREAM_ID = struct.Struct(TYPE_STREAM_ID)
+    _DATA_SIZE = struct.Struct(TYPE_DATA_SIZE)
+
     # data class identifiers
     DATACLASS_SCALAR = 0
     DATACLASS_VECTOR = 1
@@ -70,133 +138,342 @@ class Parser:
                     8:  'float32',
                     9:  'float64',
                     10: 'bool'}
+    _SCALAR_DTYPES = tuple(np.dtype(name) for _, name in sorted(SCALAR_TYPES.items()))  # numpy dtype by type id
+
+    def __init__(self, filename, memmap_dir=None, copy=True):
+        self._setup(filename, memmap_dir, copy)
+
+        with open(self._filename, 'rb') as f:
+            mm = self._map_file(f)
+        buf = np.frombuffer(mm, np.uint8)  # single view of the whole file that all arrays are taken from
+
+        # parse the log file on construction
+        self._parse(mm, buf)
 
-    def __init__(self, filename):
+        # convert parsed data into numpy arrays
+        self._convert(buf)
+
+    @classmethod
+    def iter_records(cls, filename, chunk_size=1 << 26):
+        """Parses a log file incrementally, yielding (name, time, data) for each stream in each chunk of the file
+
+        Only the records of about chunk_size bytes of the file are held in memory at a time.
+        """
+        if chunk_size <= 0:
+            raise ValueError('chunk_size must be positive')
+
+        parser = cls.__new__(cls)
+        parser._setup(filename, None, True, keep_replaced=True)
+
+        with open(filename, 'rb') as f:
+            mm = parser._map_file(f)
+        buf = np.frombuffer(mm, np.uint8)
+
+        off = 0
+        while off < len(mm):
+            off = parser._parse(mm, buf, off, off + chunk_size)
+            for name, time, data in parser._collect(buf):
+                if len(time) > 0:
+                    yield name, time, data
+
+    def _setup(self, filename, memmap_dir, copy, keep_replaced=False):
         self._filename = filename
+        self._memmap_dir = memmap_dir  # directory for file-backed data arrays, None to keep them in memory
+        self._copy = copy  # False to return streams at a constant stride as views of the mapped file
+        self._keep_replaced = keep_replaced  # True to collect the records of replaced streams instead of discarding them
 
         self.time = {}  # contains timestamps for the data
         self.data = {}  # contains the logged data
 
-        self._metadata = {}  # contains information about the streams
-        self._time_bytestream = {}  # bytestream buckets for timestamps
-        self._data_bytestream = {}  # bytestream buckets for data
+        self._metadata = []  # contains information about the streams (None if replaced), by stream index
+        self._stream_index = {}  # dense index of each stream ID, in order of appearance
+        self._data_offsets = []  # file offsets of the data records, by stream index
+        self._stream_cache = {}  # (data record offset appender, timestamp and payload size) for each stream ID
+
+        self._data_chunks = []  # (file offsets, stream indices) of the data records found by the compiled scanner
+        self._scan_index = np.full(0, -1, dtype=np.int64)  # stream index by stream ID for the compiled scanner
+        self._record_sizes = np.empty(0, dtype=np.int64)  # timestamp and payload size by stream index
 
-        # binary format decoders
-        self._read_stream_id = lambda f: struct.unpack(
-            self.TYPE_STREAM_ID, f.read(struct.calcsize(self.TYPE_STREAM_ID)))[0]
-        self._read_data_class = lambda f: struct.unpack(
-            self.TYPE_DATA_CLASS, f.read(struct.calcsize(self.TYPE_DATA_CLASS)))[0]
-        self._read_scalar_type = lambda f: struct.unpack(
-            self.TYPE_SCALAR_TYPE, f.read(struct.calcsize(self.TYPE_SCALAR_TYPE)))[0]
-        self._read_data_size = lambda f: struct.unpack(
-            self.TYPE_DATA_SIZE, f.read(struct.calcsize(self.TYPE_DATA_SIZE)))[0]
+        self._marker_handler = {self._MARKER_DATA: self._read_data,  # marker: record handler function
+                                self._MARKER_METADATA: self._read_metadata,
+                                self._MARKER_LABELS: self._read_labels}
 
         self._format_handler = {self.DATACLASS_SCALAR: self._read_scalar_format,  # data class id: metadata handler function
                                self.DATACLASS_VECTOR: self._read_vector_format,
                                self.DATACLASS_MATRIX: self._read_matrix_format}
 
-        # parse the log file on construction
-        self._parse()
-
-        # convert parsed data into numpy arrays
-        self._convert()
+    def _map_file(self, f):
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # empty files, pipes and other files that cannot be mapped
+            return self._read_file(f)
 
-    def _parse(self):
-        with open(self._filename, 'rb') as f:
-            while True:
-                try:
-                    byte = f.read(1)
-                    if byte == self.MARKER_DATA:
-                        self._read_data(f)
-                    elif byte == self.MARKER_METADATA:
-                        self._read_metadata(f)
-                    elif byte == self.MARKER_LABELS:
-                        self._read_labels(f)
-                    elif byte == self.EOF:
-                        break
-                    else:
-                        raise InvalidLogFile()
-
-                except EOFError:
-                    break
-
-    def _read_metadata(self, f):
+    def _read_file(self, f):
+        chunks = []
+        while True:
+            chunk = os.read(f.fileno(), self.READ_BUFFER_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def _parse(self, mm, buf, off=0, stop=None):
+        """Parses the records starting before stop (the end of the file by default), returning the offset reached"""
+        # bind everything used per record to locals
+        marker_data = self._MARKER_DATA
+        scan_data = self._scan_data if numba is not None else None
+        unpack_stream_id = self._STREAM_ID.unpack_from
+        get_handler = self._marker_handler.get
+
+        if scan_data is not None:  # output buffers of the compiled scanner, reused by every call
+            scan_offsets = np.empty(self.SCAN_CHUNK_RECORDS, dtype=np.intp)
+            scan_stream_indices = np.empty(self.SCAN_CHUNK_RECORDS, dtype=np.uint16)  # at most SCAN_MAX_STREAM_ID
+
+        size = len(mm)
+        stop = size if stop is None else min(stop, size)
+        while off < stop:
+            try:
+                marker = mm[off]
+                if marker == marker_data and scan_data is not None and off + _DATA_HEADER_SIZE <= size:
+                    # only call the compiled scanner for records of streams it can scan
+                    stream_id = unpack_stream_id(mm, off + 1)[0]
+                    scan_index = self._scan_index
+                    if stream_id < len(scan_index) and scan_index[stream_id] >= 0:
+                        end = scan_data(buf, off, stop, scan_offsets, scan_stream_indices)
+                        if end != off:
+                            off = end
+                            continue
+
+                handler = get_handler(marker)
+                if handler is None:
+                    raise InvalidLogFile()
+                off = handler(mm, off + 1)
+
+            except EOFError:
+                return size
+
+        return off
+
+    def _unpack(self, mm, off, decoder):
+        end = off + decoder.size
+        if end > len(mm):
+            raise EOFError()
+        return decoder.unpack_from(mm, off)[0], end
+
+    def _read_stream_id(self, mm, off):
+        return self._unpack(mm, off, self._STREAM_ID)
+
+    def _read_byte(self, mm, off):
+        if off >= len(mm):
+            raise EOFError()
+        return mm[off], off + 1  # indexing yields the byte as an int
+
+    def _read_data_class(self, mm, off):
+        return self._read_byte(mm, off)
+
+    def _read_scalar_type(self, mm, off):
+        return self._read_byte(mm, off)
+
+    def _read_data_size(self, mm, off):
+        return self._unpack(mm, off, self._DATA_SIZE)
+
+    def _read_metadata(self, mm, off):
 
         # get stream ID
-        stream_id = self._read_stream_id(f)
-        self._metadata[stream_id] = {}
+        stream_id, off = self._read_stream_id(mm, off)
+        metadata = {}
 
         # get stream name
-        self._metadata[stream_id]['name'] = self._read_string(f)
+        metadata['name'], off = self._read_string(mm, off)
 
         # get data class
-        self._metadata[stream_id]['class'] = self._read_data_class(f)
+        metadata['class'], off = self._read_data_class(mm, off)
 
         # get format dtype
-        self._metadata[stream_id]['dtype'] = \
-            self._format_handler[self._metadata[stream_id]['class']](f)
-
-        # initialize bytestreams
-        self._time_bytestream[stream_id] = io.BytesIO()
-        self._data_bytestream[stream_id] = io.BytesIO()
-
-    def _read_labels(self, f):
-        stream_id = self._read_stream_id(f)
-
-        labels = [self._read_string(f)
-                  for _ in range(len(self._metadata[stream_id]['dtype']))]
-
-        self._metadata[stream_id]['labels'] = tuple(labels)
-        self._metadata[stream_id]['dtype'].names = self._metadata[stream_id]['labels']
-
-    def _read_string(self, f):
-        b = io.BytesIO()
+        metadata['dtype'], off = self._format_handler[metadata['class']](mm, off)
+
+        # register the stream only once its metadata has been read completely, discarding any
+        # earlier stream with the same ID along with its data unless its records are kept
+        if stream_id in self._stream_index and not self._keep_replaced:
+            self._metadata[self._stream_index[stream_id]] = None
+
+        index = len(self._metadata)
+        record_size = self.TIMESTAMP_DTYPE.itemsize + metadata['dtype'].itemsize
+        self._stream_index[stream_id] = index
+        self._metadata.append(metadata)
+        self._data_offsets.append([])
+        self._record_sizes = np.append(self._record_sizes, record_size)
+
+        self._stream_cache[stream_id] = (self._data_offsets[index].append, record_size)
+
+        if stream_id <= self.SCAN_MAX_STREAM_ID and index <= self.SCAN_MAX_STREAM_ID:
+            if stream_id >= len(self._scan_index):
+                self._scan_index = np.append(
+                    self._scan_index, np.full(stream_id + 1 - len(self._scan_index), -1))
+            self._scan_index[stream_id] = index
+        elif stream_id < len(self._scan_index):  # leave the records of a redefined stream to the Python walker
+            self._scan_index[stream_id] = -1
+
+        return off
+
+    def _read_labels(self, mm, off):
+        stream_id, off = self._read_stream_id(mm, off)
+        metadata = self._metadata[self._stream_index[stream_id]]
+
+        # a single scalar has a plain dtype without fields, but is still given one label
+        dtype = metadata['dtype']
+        labels = []
+        for _ in range(len(dtype.names) if dtype.names is not None else 1):
+            label, off = self._read_string(mm, off)
+            labels.append(label)
+
+        metadata['labels'] = tuple(labels)
+
+        # rename the fields in a new dtype, the old one is shared with any arrays already collected
+        if dtype.names is not None:
+            metadata['dtype'] = np.dtype([(label, dtype[i]) for i, label in enumerate(labels)])
+
+        return off
+
+    def _read_string(self, mm, off):
+        end = mm.find(self.NULL_TERMINATOR, off)
+        if end < 0:
+            raise EOFError()
+        return mm[off:end].decode(), end + 1
+
+    def _read_scalar_format(self, mm, off):
+        num_scalars, off = self._read_data_size(mm, off)
+        if off + num_scalars > len(mm):
+            raise EOFError()
+
+        # the scalar types are consecutive bytes, read them all at once
+        dtypes = [self._SCALAR_DTYPES[scalar_type] for scalar_type in mm[off:off + num_scalars]]
+        off += num_scalars
+
+        if len(dtypes) == 1:  # a single scalar is not a structured type
+            return dtypes[0], off
+        return np.dtype([('f{}'.format(i), dtype) for i, dtype in enumerate(dtypes)]), off
+
+    def _read_vector_format(self, mm, off):
+        scalar_type, off = self._read_scalar_type(mm, off)
+        elements, off = self._read_data_size(mm, off)
+
+        return np.dtype((self._SCALAR_DTYPES[scalar_type], (elements,))), off
+
+    def _read_matrix_format(self, mm, off):
+        scalar_type, off = self._read_scalar_type(mm, off)
+        rows, off = self._read_data_size(mm, off)
+        cols, off = self._read_data_size(mm, off)
+
+        # matrices are stored column-major, so each column is contiguous
+        return np.dtype((self._SCALAR_DTYPES[scalar_type], (cols, rows))), off
+
+    def _read_data(self, mm, off):
+        time_off = off + self._STREAM_ID.size
+        if time_off > len(mm):
+            raise EOFError()
+        stream_id = self._STREAM_ID.unpack_from(mm, off)[0]
+
+        append_offset, record_size = self._stream_cache[stream_id]
+        end = time_off + record_size
+        if end > len(mm):
+            raise EOFError()  # drop a truncated trailing record
+
+        append_offset(time_off)
+        return end
+
+    def _scan_data(self, buf, off, stop, offsets, stream_indices):
+        """Scans data records starting before stop with the compiled scanner, returning the offset at which it stopped"""
         while True:
-            byte = f.read(1)
-            if byte == b'\x00':
-                break
-            # TODO check for EOF?
-            b.write(byte)
-        return b.getvalue().decode()
-
-    def _read_scalar_format(self, f):
-        num_scalars = self._read_data_size(f)
-        dtypes = [self.SCALAR_TYPES[self._read_scalar_type(f)]
-                  for _ in range(num_scalars)]
-
-        return np.dtype(','.join(dtypes))
-
-    def _read_vector_format(self, f):
-        scalar_type = self._read_scalar_type(f)
-        elements = self._read_data_size(f)
-
-        return np.dtype('({},){}'.format(
-            elements, self.SCALAR_TYPES[scalar_type]))
-
-    def _read_matrix_format(self, f):
-        scalar_type = self._read_scalar_type(f)
-        rows = self._read_data_size(f)
-        cols = self._read_data_size(f)
-
-        return np.dtype('({},{}){}'.format(
-            rows, cols, self.SCALAR_TYPES[scalar_type]))
-
-    def _read_data(self, f):
-        stream_id = self._read_stream_id(f)
-        self._time_bytestream[stream_id].write(
-            f.read(self.TIMESTAMP_DTYPE.itemsize))
-        self._data_bytestream[stream_id].write(
-            f.read(self._metadata[stream_id]['dtype'].itemsize))
-
-    def _convert(self):
-        for stream_id in self._metadata.keys():
-            self.time[self._metadata[stream_id]['name']] = np.frombuffer(
-                self._time_bytestream[stream_id].getvalue(), self.TIMESTAMP_DTYPE)
-
-            dtype = self._metadata[stream_id]['dtype']
-            if dtype.ndim == 2:  # transpose matrices after reading from column-major to row-major
-                self.data[self._metadata[stream_id]['name']] = np.swapaxes(np.frombuffer(
-                    self._data_bytestream[stream_id].getvalue(), dtype), 1, 2)
-            else:
-                self.data[self._metadata[stream_id]['name']] = np.frombuffer(
-                    self._data_bytestream[stream_id].getvalue(), dtype)
+            off, count = _scan_data_records(buf, off, stop, self._MARKER_DATA, self._scan_index,
+                                            self._record_sizes, offsets, stream_indices)
+            if count > 0:
+                self._data_chunks.append((offsets[:count].copy(), stream_indices[:count].copy()))
+            if count < len(offsets):
+                return off
+
+    def _gather(self, buf, offsets, dtype):
+        """Collects the fixed-size items of dtype found at the given offsets of buf into an array"""
+        if len(offsets) == 0:
+            return np.frombuffer(b'', dtype)
+
+        # items at a constant stride, such as the records of a log with a single stream, are a view of
+        # the mapped file, which changes with the file, so it is only returned if copying is disabled
+        stride = offsets[1] - offsets[0] if len(offsets) > 1 else dtype.itemsize
+        if np.all(np.diff(offsets) == stride):
+            view = np.ndarray((len(offsets),), dtype, buffer=buf, offset=offsets[0], strides=(stride,))
+            if not self._copy:
+                return view
+
+            items = np.frombuffer(self._allocate((len(offsets), dtype.itemsize)), dtype)
+            items[...] = view  # one strided copy
+            return items
+
+        items = self._allocate((len(offsets), dtype.itemsize))
+        if numba is not None:  # copy the items in parallel
+            _gather_records(buf, offsets, items)
+        else:
+            # indexing a sliding window view copies each item in one pass without building an
+            # index array for every byte of every item, in blocks to bound the temporary copies
+            windows = np.lib.stride_tricks.as_strided(buf, (len(buf) - dtype.itemsize + 1, dtype.itemsize),
+                                                      (buf.strides[0], buf.strides[0]), writeable=False)
+            for start in range(0, len(offsets), self.GATHER_BLOCK_RECORDS):
+                block = offsets[start:start + self.GATHER_BLOCK_RECORDS]
+                items[start:start + len(block)] = windows[block]
+
+        return np.frombuffer(items, dtype)
+
+    def _allocate(self, shape):
+        """Allocates a uint8 array, backed by an anonymous temporary file if memmap_dir is set"""
+        if self._memmap_dir is None:
+            return np.empty(shape, dtype=np.uint8)
+
+        with tempfile.TemporaryFile(dir=self._memmap_dir) as f:
+            return np.memmap(f, dtype=np.uint8, mode='w+', shape=shape).view(np.ndarray)
+
+    def _convert(self, buf):
+        for name, time, data in self._collect(buf):
+            self.time[name] = time
+            self.data[name] = data
+
+    def _collect(self, buf):
+        """Yields (name, time, data) for each stream from the records parsed so far, then forgets those records"""
+        scanned_offsets = []  # offsets of the data records found by the compiled scanner, by stream index
+        if self._data_chunks:
+            offsets = np.concatenate([offsets for offsets, _ in self._data_chunks])
+            stream_indices = np.concatenate([stream_indices for _, stream_indices in self._data_chunks])
+
+            # group the records by stream with one stable sort, then split them at the per-stream counts
+            counts = np.bincount(stream_indices)
+            scanned_offsets = np.split(offsets[np.argsort(stream_indices, kind='stable')], np.cumsum(counts)[:-1])
+
+        for index, metadata in enumerate(self._metadata):
+            if metadata is None:  # replaced by a later stream with the same ID
+                continue
+
+            offsets = np.array(self._data_offsets[index], dtype=np.intp)
+            if index < len(scanned_offsets):
+                if len(offsets) == 0:
+                    offsets = scanned_offsets[index]
+                else:  # merge with the records found by the compiled scanner in file order
+                    offsets = np.sort(np.concatenate((offsets, scanned_offsets[index])), kind='stable')
+
+            # collect the timestamp and payload of each record together, then view them separately
+            name, dtype = metadata['name'], metadata['dtype']
+            records = self._gather(buf, offsets, np.dtype([('time', self.TIMESTAMP_DTYPE), ('data', dtype)]))
+
+            data = records['data']
+            if dtype.ndim == 2:  # expose column-major matrices as (rows, cols) without copying
+                data = np.swapaxes(data, 1, 2)
+
+            yield name, records['time'], data
+
+        for offsets in self._data_offsets:
+            offsets.clear()  # in place, the stream cache holds their append methods
+        self._data_chunks = []
+
+        # replaced streams get no more records once those already parsed have been collected
+        current = set(self._stream_index.values())
+        for index in range(len(self._metadata)):
+            if index not in current:
+                self._metadata[index] = None